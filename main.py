@@ -1,10 +1,12 @@
 import threading
+from collections import OrderedDict
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
 import plotly.graph_objects as go
 import webbrowser
 import numpy as np
+from numba import njit, prange
 
 
 # Defined Parameters
@@ -28,19 +30,15 @@ Ki = 0.00015
 Kd = 0.0015
 
 # Constraints
-Umax = 24
-Umin = 0
+Umax = 24.0
+Umin = 0.0
 
+# Conversion factor from angular velocity [rad/s] to RPM
+radiansPerSecondToRevolutionsPerMinute = 60 / (2 * np.pi)
 
-# Lists of measured values
-timeOfSimulationList = [0.0]
-loadMomentList = [0.0]
-electromagneticMomentList = [0.0]
-adjustmentErrors = [referencedRevolutionsPerMinute]
-voltagesList = [0.0]
-revolutionsList = [0]
+
+# Revolutions measured in previous simulation
 previousrevolutionsList = [0]
-previoustimeOfSimulationList = [0]
 
 # Calculations
 
@@ -58,6 +56,7 @@ def calculateNumberOfIterations(timeOfSimulation: int, timeOfSample: float) -> i
     return int(timeOfSimulation / timeOfSample) + 1
 
 
+@njit(cache=True, fastmath=True)
 def calculateAdjustmentError(referencedRevolutionsPerMinute: float, currentRevolutionsPerMinute: float) -> float:
     """ Calculates adjustment error which is difference between referenced value and current one
 
@@ -71,25 +70,30 @@ def calculateAdjustmentError(referencedRevolutionsPerMinute: float, currentRevol
     return referencedRevolutionsPerMinute - currentRevolutionsPerMinute
 
 
-def calculateVoltageOfRegulator(errorList: list[float], iteration: int) -> float:
+@njit(cache=True, fastmath=True)
+def calculateVoltageOfRegulator(currentError: float, previousError: float, sumOfErrors: float, iteration: int,
+                                Kp: float, Ki: float, Kd: float, timeOfSample: float) -> float:
     """ Calculates current voltage of regulator using PID control.
 
     @Parameters:
-    - errorList (list[float]): list of errors at the moment and before
+    - currentError (float): error at the moment
+    - previousError (float): error in previous iteration
+    - sumOfErrors (float): running sum of errors up to and including current iteration
     - iteration (int): information about current simulation iteration
+    - Kp, Ki, Kd (float): gains of proportional, integral and derivative part
+    - timeOfSample (float): time at which we repeat the measurement in seconds
 
     @Return:
     - float: current voltage of regulator
     """
 
-    proportional = Kp * errorList[iteration]
+    proportional = Kp * currentError
 
-    integral = Ki * sum(errorList) * timeOfSample
+    integral = Ki * sumOfErrors * timeOfSample
 
     # Deriative part can be done from second iteration
     if iteration > 0:
-        derivative = (errorList[iteration] -
-                      errorList[iteration - 1]) / timeOfSample
+        derivative = (currentError - previousError) / timeOfSample
     else:
         derivative = 0.0
 
@@ -100,6 +104,7 @@ def calculateVoltageOfRegulator(errorList: list[float], iteration: int) -> float
     return voltage
 
 
+@njit(cache=True, fastmath=True)
 def calculateElectromagneticMoment(constant: float, currentVoltage: float) -> float:
     """ Calculates current electromagnetic moment based on voltage of regulator
 
@@ -113,71 +118,264 @@ def calculateElectromagneticMoment(constant: float, currentVoltage: float) -> fl
     return constant * currentVoltage
 
 
-def calculateNormalizedVoltage(voltgeOfRegulator: float) -> float:
+@njit(cache=True, fastmath=True, inline='always')
+def calculateNormalizedVoltage(voltgeOfRegulator: float, Umin: float, Umax: float) -> float:
     """ Calculates normalized voltage based on predefined constraints <Umin;Umax> [V]
 
     @Parameters:
     - voltageOfRegulator (float): current voltage of regulator
+    - Umin, Umax (float): constraints of voltage
 
     @Return:
     - float: normalized voltage used to create electromagnetic moment
     """
+    # Compiled inline into simulation as branchless min/max instructions
     return max(Umin, min(Umax, voltgeOfRegulator))
 
 
-def convertToAngularVelocity(valueToBeConverted: float) -> float:
-    return valueToBeConverted * (2 * np.pi / 60)
-
-
-def convertToRevolutionsPerMinute(valueToBeConverted: float) -> float:
-    return valueToBeConverted * (60 / (2 * np.pi))
-
-
-def calculateRevolutions(latestRevolution: float, latestElectromagneticMoment: float) -> float:
+@njit(cache=True, fastmath=True)
+def calculateRevolutions(latestRevolution: float, latestElectromagneticMoment: float,
+                         loadMoment: float, brakingMoment: float, momentOfInertia: float,
+                         timeOfSample: float) -> float:
     """ Calculates the updated revolutions per minute (RPM) based on the system's moments.
 
         @Parameters:
         - latestRevolution (float): value of revolution in previous iteration
         - latestElectromagneticMoment (float): value of electromagnetic moment in previous iteration
+        - loadMoment (float): moment of load applied to crankshaft
+        - brakingMoment (float): braking moment of crankshaft
+        - momentOfInertia (float): moment of inertia of crankshaft
+        - timeOfSample (float): time at which we repeat the measurement in seconds
 
         @Return:
         - float: updated revolutions
     """
-    omega = convertToAngularVelocity(latestRevolution)
+    # Conversion of revolutions to angular velocity and back cancels out,
+    # only acceleration has to be expressed in RPM per second
     acceleration = (
         latestElectromagneticMoment - loadMoment - brakingMoment) / momentOfInertia
-    newOmega = omega + timeOfSample * acceleration
+    acceleration = acceleration * radiansPerSecondToRevolutionsPerMinute
+
+    return latestRevolution + timeOfSample * acceleration
+
+
+# Signature is given explicitly, so simulation is compiled (or loaded from cache)
+# at import and first slider change does not wait for it
+@njit("UniTuple(float32[::1], 2)(float64, float64, float64, float64, float64, "
+      "float64, float64, float64, float64, float64, float64, int64)",
+      cache=True, fastmath=True)
+def simulate(loadMoment: float, referencedRevolutionsPerMinute: float, Kp: float, Ki: float, Kd: float,
+             brakingMoment: float, momentOfInertia: float, constantOfElectromagneticMoment: float,
+             Umin: float, Umax: float, timeOfSample: float,
+             numberOfIterations: int) -> tuple[np.ndarray, ...]:
+    """ Runs closed loop of regulator and crankshaft
 
-    return convertToRevolutionsPerMinute(newOmega)
+        @Parameters:
+        - loadMoment (float): moment of load applied to crankshaft
+        - referencedRevolutionsPerMinute (float): set value to be obtained by regulator
+        - Kp, Ki, Kd (float): gains of proportional, integral and derivative part
+        - brakingMoment (float): braking moment of crankshaft
+        - momentOfInertia (float): moment of inertia of crankshaft
+        - constantOfElectromagneticMoment (float): used to scale moment
+        - Umin, Umax (float): constraints of voltage
+        - timeOfSample (float): time at which we repeat the measurement in seconds
+        - numberOfIterations (int): number of iterations
+
+        @Return:
+        - tuple[np.ndarray, ...]: voltages and revolutions
+    """
+    # Results are only drawn, so they are stored in single precision.
+    # State of the loop is kept in double precision and never read back from them.
+    voltagesList = np.empty(numberOfIterations, dtype=np.float32)
+    revolutionsList = np.empty(numberOfIterations, dtype=np.float32)
+
+    voltagesList[0] = 0.0
+    revolutionsList[0] = 0.0
+
+    sumOfErrors = 0.0
+    latestError = referencedRevolutionsPerMinute
+    previousError = 0.0
+    latestVoltage = 0.0
+    latestRevolution = 0.0
+    electromagneticMoment = 0.0
+    for i in range(numberOfIterations - 1):
+        sumOfErrors += latestError
+        voltage = calculateNormalizedVoltage(
+            calculateVoltageOfRegulator(
+                latestError, previousError, sumOfErrors, i, Kp, Ki, Kd, timeOfSample),
+            Umin, Umax
+        )
+        voltagesList[i + 1] = voltage
+
+        revolutions = calculateRevolutions(
+            latestRevolution, electromagneticMoment,
+            loadMoment, brakingMoment, momentOfInertia, timeOfSample)
+        revolutionsList[i + 1] = revolutions
+
+        # Moment follows voltage with one sample delay
+        electromagneticMoment = calculateElectromagneticMoment(
+            constantOfElectromagneticMoment, latestVoltage
+        )
+
+        adjustmentError = calculateAdjustmentError(
+            referencedRevolutionsPerMinute, latestRevolution
+        )
+
+        previousError = latestError
+        latestError = adjustmentError
+        latestVoltage = voltage
+        latestRevolution = revolutions
+
+    return voltagesList, revolutionsList
+
+
+@njit(cache=True, parallel=True)
+def sweep(gainsGrid: np.ndarray, loadMoment: float, referencedRevolutionsPerMinute: float,
+          brakingMoment: float, momentOfInertia: float, constantOfElectromagneticMoment: float,
+          Umin: float, Umax: float, timeOfSample: float, numberOfIterations: int) -> np.ndarray:
+    """ Runs independent simulations for every set of regulator gains in parallel, used for offline tuning
+
+        @Parameters:
+        - gainsGrid (np.ndarray): array of shape (n, 3), every row holds Kp, Ki and Kd
+        - remaining parameters: same as in simulate
+
+        @Return:
+        - np.ndarray: revolutions of shape (n, numberOfIterations), row per set of gains
+
+        @Example:
+        >>> gainsGrid = np.array([[0.007, 0.00013, 0.0015],
+        ...                       [0.01, 0.0001, 0.002]])
+        >>> revolutionsGrid = sweep(gainsGrid, loadMoment, referencedRevolutionsPerMinute,
+        ...                         brakingMoment, momentOfInertia, constantOfElectromagneticMoment,
+        ...                         Umin, Umax, timeOfSample, numberOfIterations)
+        >>> revolutionsGrid.shape == (2, numberOfIterations)
+        True
+        >>> _, revolutionsList = simulate(loadMoment, referencedRevolutionsPerMinute, 0.01, 0.0001, 0.002,
+        ...                               brakingMoment, momentOfInertia, constantOfElectromagneticMoment,
+        ...                               Umin, Umax, timeOfSample, numberOfIterations)
+        >>> np.array_equal(revolutionsGrid[1], revolutionsList)
+        True
+    """
+    revolutionsGrid = np.empty((gainsGrid.shape[0], numberOfIterations), dtype=np.float32)
+    for k in prange(gainsGrid.shape[0]):
+        _, revolutionsList = simulate(
+            loadMoment, referencedRevolutionsPerMinute,
+            gainsGrid[k, 0], gainsGrid[k, 1], gainsGrid[k, 2],
+            brakingMoment, momentOfInertia, constantOfElectromagneticMoment,
+            Umin, Umax, timeOfSample, numberOfIterations)
+        revolutionsGrid[k, :] = revolutionsList
+
+    return revolutionsGrid
 
 
 # Visualizations
+
+# Time axis and braking moment do not depend on sliders, so figures are built
+# once and callback only patches traces which change
+numberOfIterations = calculateNumberOfIterations(timeOfSimulation, timeOfSample)
+timeOfSimulationList = np.empty(numberOfIterations, dtype=np.float64)
+timeOfSimulationList[0] = 0.0
+np.cumsum(np.full(numberOfIterations - 1, timeOfSample),
+          out=timeOfSimulationList[1:])
+
+# Screen cannot show every sample, so only every plotStride-th one is sent to browser
+maximumNumberOfPlottedPoints = 1000
+plotStride = max(1, numberOfIterations // maximumNumberOfPlottedPoints)
+plottedTimeOfSimulationList = timeOfSimulationList[::plotStride]
+
+# Constant moments are drawn as segment between first and last sample
+timeOfSimulationBounds = [timeOfSimulationList[0], timeOfSimulationList[-1]]
+
+# Moments graph (Load, Electromagnetic, and Braking Moment)
+momentsFigure = go.Figure()
+
+momentsFigure.add_trace(go.Scattergl(
+    x=timeOfSimulationBounds,
+    y=[],
+    mode='lines',
+    name='Load Moment',
+    line=dict(color='blue')
+))
+
+momentsFigure.add_trace(go.Scattergl(
+    x=plottedTimeOfSimulationList,
+    y=[],
+    mode='lines',
+    name='Electromagnetic Moment',
+    line=dict(color='red')
+))
+
+momentsFigure.add_trace(go.Scattergl(
+    x=timeOfSimulationBounds,
+    y=[brakingMoment, brakingMoment],
+    mode='lines',
+    name='Braking Moment',
+    line=dict(color='green')
+))
+
+momentsFigure.update_layout(
+    title=f"Load, Electromagnetic, and Braking Moment ({brakingMoment}) Over Time",
+    xaxis_title="Time (s)",
+    yaxis_title="Moment (Nm)"
+)
+
+# Revolutions graph
+revolutionsFigure = go.Figure()
+
+revolutionsFigure.add_trace(go.Scattergl(
+    x=plottedTimeOfSimulationList,
+    y=[],
+    mode='lines',
+    name='Revolutions'
+))
+
+revolutionsFigure.add_trace(go.Scattergl(
+    x=plottedTimeOfSimulationList,
+    y=previousrevolutionsList,
+    mode='lines',
+    name='previousRevolutions',
+    line=dict(color='gray', dash="dash")
+))
+
+revolutionsFigure.add_hline(y=referencedRevolutionsPerMinute, line_dash="dot",
+                            annotation_text="Target RPM")
+revolutionsFigure.update_layout(
+    title="Revolutions Over Time",
+    xaxis_title="Time (s)",
+    yaxis_title="Revolutions per Minute (RPM)"
+)
+
 app = dash.Dash(__name__)
 
+# Sliders trigger simulation only when released, not on every position while dragged
 app.layout = html.Div([
     html.Div([
         html.Label("Load Moment"),
         dcc.Slider(
             id='slider-loadMoment', min=1, max=5, step=0.1, value=1,
-            marks={i: str(i) for i in range(1, 11)}
+            marks={i: str(i) for i in range(1, 11)},
+            updatemode='mouseup'
         ),
         html.Label("Referenced RPMs"),
         dcc.Slider(
             id='slider-referencedRevolutionsPerMinute', min=1000, max=5000, step=1000, value=3000,
-            marks={i: str(i*1000) for i in range(1, 6)}
+            marks={i: str(i*1000) for i in range(1, 6)},
+            updatemode='mouseup'
         ),
         html.Label("Kp"),
         dcc.Slider(
             id='slider-Kp', min=0.001, max=0.02, step=0.001, value=0.007,
             marks={round(i, 3): str(round(i, 3))
-                   for i in [0.001, 0.005, 0.01, 0.015, 0.02]}
+                   for i in [0.001, 0.005, 0.01, 0.015, 0.02]},
+            updatemode='mouseup'
         ),
         html.Label("Ki"),
         dcc.Slider(
             id='slider-Ki',
             min=0.00001, max=0.00025, step=0.00001, value=0.00013,
             marks={round(i, 5): str(round(i, 5))
-                   for i in [0.00001, 0.00007, 0.00013, 0.00019, 0.00025]}
+                   for i in [0.00001, 0.00007, 0.00013, 0.00019, 0.00025]},
+            updatemode='mouseup'
         ),
 
         html.Label("Kd"),
@@ -185,17 +383,67 @@ app.layout = html.Div([
             id='slider-Kd',
             min=0.0001, max=0.01, step=0.0001, value=0.0015,
             marks={round(i, 4): str(round(i, 4))
-                   for i in [0.0001, 0.0026, 0.0051, 0.0076, 0.01]}
+                   for i in [0.0001, 0.0026, 0.0051, 0.0076, 0.01]},
+            updatemode='mouseup'
         ),
     ], style={'width': '50%', 'margin': 'auto'}),
 
     html.Div([
-        dcc.Graph(id='moments-graph'),
-        dcc.Graph(id='revolutions-graph')
+        dcc.Graph(id='moments-graph', figure=momentsFigure),
+        dcc.Graph(id='revolutions-graph', figure=revolutionsFigure)
     ]),
 ])
 
 
+# Plotted results of recent simulations by rounded slider values, least recently used first
+cachedSimulations = OrderedDict()
+maximumNumberOfCachedSimulations = 32
+# Callbacks run in threads of the server, so cache is only accessed under lock
+cachedSimulationsLock = threading.Lock()
+
+
+def calculatePlottedResults(loadMoment: float, referencedRevolutionsPerMinute: float,
+                            Kp: float, Ki: float, Kd: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Simulates process for values set on sliders, reusing result if they were already simulated
+
+        @Parameters:
+        - loadMoment (float): moment of load applied to crankshaft
+        - referencedRevolutionsPerMinute (float): set value to be obtained by regulator
+        - Kp, Ki, Kd (float): gains of proportional, integral and derivative part
+
+        @Return:
+        - tuple[np.ndarray, np.ndarray]: electromagnetic moments and revolutions at plotted samples
+    """
+    key = tuple(round(value, 8) for value in (
+        loadMoment, referencedRevolutionsPerMinute, Kp, Ki, Kd))
+    with cachedSimulationsLock:
+        if key in cachedSimulations:
+            cachedSimulations.move_to_end(key)
+            return cachedSimulations[key]
+
+    voltagesList, revolutionsList = simulate(
+        loadMoment, referencedRevolutionsPerMinute, Kp, Ki, Kd,
+        brakingMoment, momentOfInertia, constantOfElectromagneticMoment,
+        Umin, Umax, timeOfSample, numberOfIterations)
+
+    # Electromagnetic moment is not fed back to regulator, so it is computed outside of the loop
+    electromagneticMomentList = np.empty(numberOfIterations, dtype=np.float32)
+    electromagneticMomentList[0] = 0.0
+    np.multiply(voltagesList[:-1], constantOfElectromagneticMoment,
+                out=electromagneticMomentList[1:])
+
+    # Copies, so cache does not keep all samples alive
+    plottedResults = (electromagneticMomentList[::plotStride].copy(),
+                      revolutionsList[::plotStride].copy())
+
+    with cachedSimulationsLock:
+        cachedSimulations[key] = plottedResults
+        if len(cachedSimulations) > maximumNumberOfCachedSimulations:
+            cachedSimulations.popitem(last=False)
+
+    return plottedResults
+
+
 @app.callback(
     [
         Output('moments-graph', 'figure'),
@@ -210,113 +458,28 @@ app.layout = html.Div([
     ]
 )
 def updateGraphs(newLoadMoment, newReferencedRPM, newKp, newKi, newKd):
-    # Update global parameters
-    global loadMoment, referencedRevolutionsPerMinute, Kp, Ki, Kd
-    loadMoment = newLoadMoment
-    referencedRevolutionsPerMinute = newReferencedRPM
-    Kp = newKp
-    Ki = newKi
-    Kd = newKd
-
-    # Reinitialize global lists
-    global timeOfSimulationList, loadMomentList, electromagneticMomentList
-    global adjustmentErrors, voltagesList, revolutionsList, brakingMomentList, previousrevolutionsList, previoustimeOfSimulationList
-    timeOfSimulationList = [0.0]
-    loadMomentList = [0.0]
-    electromagneticMomentList = [0.0]
-    adjustmentErrors = [referencedRevolutionsPerMinute]
-    voltagesList = [0.0]
-    revolutionsList = [0]
-    brakingMomentList = [brakingMoment]
+    global previousrevolutionsList
 
     # Simulation
-    for i in range(int(timeOfSimulation / timeOfSample)):
-        timeOfSimulationList.append(timeOfSimulationList[i] + timeOfSample)
-
-        voltage = calculateNormalizedVoltage(
-            calculateVoltageOfRegulator(adjustmentErrors, i)
-        )
-        voltagesList.append(voltage)
+    plottedElectromagneticMomentList, plottedRevolutionsList = calculatePlottedResults(
+        newLoadMoment, newReferencedRPM, newKp, newKi, newKd)
 
-        electromagneticMoment = calculateElectromagneticMoment(
-            constantOfElectromagneticMoment, voltagesList[i]
-        )
-        electromagneticMomentList.append(electromagneticMoment)
+    # Moments graph, braking moment stays as built
+    momentsPatch = dash.Patch()
+    momentsPatch['data'][0]['y'] = [newLoadMoment, newLoadMoment]
+    momentsPatch['data'][1]['y'] = plottedElectromagneticMomentList
 
-        revolutions = calculateRevolutions(
-            revolutionsList[i], electromagneticMomentList[i])
-        revolutionsList.append(revolutions)
+    # Revolutions graph
+    revolutionsPatch = dash.Patch()
+    revolutionsPatch['data'][0]['y'] = plottedRevolutionsList
+    revolutionsPatch['data'][1]['y'] = previousrevolutionsList
+    revolutionsPatch['layout']['shapes'][0]['y0'] = newReferencedRPM
+    revolutionsPatch['layout']['shapes'][0]['y1'] = newReferencedRPM
+    revolutionsPatch['layout']['annotations'][0]['y'] = newReferencedRPM
 
-        adjustmentError = calculateAdjustmentError(
-            referencedRevolutionsPerMinute, revolutionsList[i]
-        )
-        adjustmentErrors.append(adjustmentError)
-        loadMomentList.append(loadMoment)
-        brakingMomentList.append(brakingMoment)
-
-    # Moments graph (Load, Electromagnetic, and Braking Moment)
-    momentsFigure = go.Figure()
-
-    momentsFigure.add_trace(go.Scatter(
-        x=timeOfSimulationList,
-        y=loadMomentList,
-        mode='lines',
-        name='Load Moment',
-        line=dict(color='blue')
-    ))
-
-    momentsFigure.add_trace(go.Scatter(
-        x=timeOfSimulationList,
-        y=electromagneticMomentList,
-        mode='lines',
-        name='Electromagnetic Moment',
-        line=dict(color='red')
-    ))
-
-    momentsFigure.add_trace(go.Scatter(
-        x=timeOfSimulationList,
-        y=brakingMomentList,
-        mode='lines',
-        name='Braking Moment',
-        line=dict(color='green')
-    ))
-
-    momentsFigure.update_layout(
-        title=f"Load, Electromagnetic, and Braking Moment ({
-            brakingMoment}) Over Time",
-        xaxis_title="Time (s)",
-        yaxis_title="Moment (Nm)"
-    )
+    previousrevolutionsList = plottedRevolutionsList
 
-    # Revolutions graph
-    revolutionsFigure = go.Figure()
-
-    revolutionsFigure.add_trace(go.Scatter(
-        x=timeOfSimulationList,
-        y=revolutionsList,
-        mode='lines',
-        name='Revolutions'
-    ))
-
-    revolutionsFigure.add_trace(go.Scatter(
-        x=previoustimeOfSimulationList,
-        y=previousrevolutionsList,
-        mode='lines',
-        name='previousRevolutions',
-        line=dict(color='gray', dash="dash")
-    ))
-
-    revolutionsFigure.add_hline(y=referencedRevolutionsPerMinute, line_dash="dot",
-                                annotation_text="Target RPM")
-    revolutionsFigure.update_layout(
-        title="Revolutions Over Time",
-        xaxis_title="Time (s)",
-        yaxis_title="Revolutions per Minute (RPM)"
-    )
-    previousrevolutionsList = revolutionsList
-    previoustimeOfSimulationList = timeOfSimulationList
-
-    return momentsFigure, revolutionsFigure
+    return momentsPatch, revolutionsPatch
 
 
 def openBrowser():